@@ -4,84 +4,476 @@ Simple model loader + inference helper for locally-run LLMs.
 - Attempts to load the specified model in 4-bit (bitsandbytes) when a CUDA device is available.
 - Falls back to a standard HF load on failure.
 - Exposes `ask(prompt, max_new_tokens)` for simple prompt-response inference.
+- Exposes `ask_batch(prompts, max_new_tokens)` to decode several prompts per forward pass, and
+  `ask_batch_async(...)`, which returns a Future so detokenization overlaps the next batch.
+- Exposes `encode_prompts(prompts)` to tokenize a whole suite once up front (reused via `ask_batch(..., input_ids=)`).
+- Exposes `shared_prefix_len(input_ids)`; a long shared prompt prefix is prefilled once and its KV cache reused.
+- With TRUST_BACKEND=vllm, serves generation from a vLLM engine (paged KV cache + continuous batching).
 Environment:
 - Set model override: $env:TRUST_MODEL = "hf-username/model-name"
+- Select quantization: $env:TRUST_QUANT = "bnb" (default, NF4 on the fly) or "awq" (pre-quantized
+  AWQ checkpoint with fused dequant+matmul kernels; needs autoawq, defaults TRUST_MODEL to AWQ_MODEL)
+- Select backend: $env:TRUST_BACKEND = "hf" (default) or "vllm"
+- Tensor-parallel degree for vLLM: $env:TP = "1"
+- Compile the HF decode step (torch.compile + static KV cache): $env:TRUST_COMPILE = "1"
+- Decode batches with a hand-written greedy loop over a StaticCache instead of `generate`: $env:TRUST_GREEDY_LOOP = "1"
+- Output cache directory (greedy outputs are reused across reruns): $env:TRUST_CACHE_DIR = "results/_cache"
+  (set to an empty string to disable)
 """
 
+import contextlib
+import copy
+import hashlib
+import importlib.util
 import os
+import tempfile
 import warnings
-from typing import Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
 
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from transformers import BitsAndBytesConfig
 
+# "bnb" = bitsandbytes NF4 at load time, "awq" = pre-quantized AWQ checkpoint
+QUANT = os.environ.get("TRUST_QUANT", "bnb").lower()
+BASE_MODEL = "mistralai/Mistral-7B-Instruct-v0.1"
+AWQ_MODEL = "TheBloke/Mistral-7B-Instruct-v0.1-AWQ"
 # Default HF model (change via TRUST_MODEL env var or in code)
-MODEL = os.environ.get("TRUST_MODEL", "mistralai/Mistral-7B-Instruct-v0.1")
+MODEL = os.environ.get("TRUST_MODEL", AWQ_MODEL if QUANT == "awq" else BASE_MODEL)
+# "hf" = transformers generate, "vllm" = vLLM engine
+BACKEND = os.environ.get("TRUST_BACKEND", "hf").lower()
+# torch.compile the HF forward ("reduce-overhead" = CUDA graphs) and decode into a static cache
+COMPILE = os.environ.get("TRUST_COMPILE", "0") == "1"
+# replace HF `generate` (logits processors, stopping criteria, ...) by a bare argmax loop
+GREEDY_LOOP = os.environ.get("TRUST_GREEDY_LOOP", "0") == "1"
 
 _tokenizer = None
+# private copy for the decode thread: the Rust tokenizer is not safe to share across threads
+# (encoding mutates its padding/truncation state -> "Already borrowed")
+_decode_tokenizer = None
 _model = None
+_engine = None
+_device = None  # device of the model's first parameters, cached at load time
+_prefix_kv = None  # (prefix token ids, KV cache of that prefix at batch size 1)
+_load_mode = None  # how the model was actually loaded (e.g. "bnb-nf4-bfloat16"), part of the cache key
+# one background thread copies finished batches to the host and detokenizes them (FIFO order)
+_decode_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="decode")
+
+# shared prompt prefixes shorter than this are cheaper to re-encode than to cache
+PREFIX_MIN_TOKENS = 16
+
+# decoding is greedy (deterministic), so outputs are cached on disk by
+# (model, backend, effective load mode, budget, prompt); lookups happen after the model is loaded
+CACHE_DIR = os.environ.get("TRUST_CACHE_DIR", os.path.join("results", "_cache"))
+
+def _cache_path(prompt: str, max_new_tokens: int) -> str:
+    key = f"{MODEL}|{BACKEND}|{_load_mode}|{max_new_tokens}|{prompt}"
+    key = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_DIR, f"{key}.txt")
+
+def _cache_get(prompt: str, max_new_tokens: int) -> Optional[str]:
+    """Cached output for this prompt, or None on a miss (or when caching is disabled)."""
+    if not CACHE_DIR:
+        return None
+    try:
+        with open(_cache_path(prompt, max_new_tokens), "r", encoding="utf-8", newline="") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _cache_put(prompt: str, max_new_tokens: int, text: str):
+    """
+    Write through a temp file + os.replace so concurrent runs never see a partial entry.
+    A failed write (unwritable dir, full disk) only warns: the output itself is still good.
+    """
+    if not CACHE_DIR:
+        return
+    tmp = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(text)
+        os.replace(tmp, _cache_path(prompt, max_new_tokens))
+    except BaseException as e:
+        if tmp is not None:
+            with contextlib.suppress(OSError):
+                os.remove(tmp)
+        if not isinstance(e, OSError):
+            raise
+        warnings.warn(f"[cache] Could not write cache entry in {CACHE_DIR}: {e}")
+
+def _load_vllm() -> Tuple[object, object]:
+    """Build a vLLM engine for MODEL. Returns (tokenizer, engine)."""
+    try:
+        from vllm import LLM
+    except ImportError as e:
+        raise RuntimeError("TRUST_BACKEND=vllm requires the vllm package (pip install vllm).") from e
+    print(f"[loader] Starting vLLM engine for {MODEL} ...")
+    engine = LLM(
+        model=MODEL,
+        # for AWQ, let vLLM read the checkpoint config so it can pick its Marlin kernel
+        quantization=None if QUANT == "awq" else "bitsandbytes",
+        # older vLLM releases reject bitsandbytes quantization unless the load format matches
+        load_format="auto" if QUANT == "awq" else "bitsandbytes",
+        dtype="float16" if QUANT == "awq" else "bfloat16",
+        tensor_parallel_size=int(os.environ.get("TP", 1)),
+        enable_prefix_caching=True,  # shared system/instruction prefixes are prefilled once
+        trust_remote_code=True
+    )
+    print("[loader] vLLM engine ready.")
+    return engine.get_tokenizer(), engine
+
+def _prepare_model(tokenizer, model):
+    """Set generation defaults and, with TRUST_COMPILE=1, compile the forward pass."""
+    # a known pad id lets generate pre-allocate the static cache and skips the per-call warning
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    if COMPILE:
+        print("[loader] Compiling model forward with torch.compile(mode='reduce-overhead') ...")
+        model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False, dynamic=True)
+    return model
+
+def _generate_kwargs() -> dict:
+    """Extra kwargs for `generate`; a static cache keeps shapes fixed for the compiled graph."""
+    return {"cache_implementation": "static"} if COMPILE else {}
+
+def _attn_implementation() -> str:
+    """
+    FlashAttention-2 when its wheel is installed and the GPU supports it (Ampere+), else PyTorch SDPA.
+    The static-cache modes (TRUST_COMPILE, TRUST_GREEDY_LOOP) always get SDPA: transformers'
+    FA2 attention rejects a StaticCache.
+    """
+    if COMPILE or GREEDY_LOOP:
+        return "sdpa"
+    if (torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
+            and importlib.util.find_spec("flash_attn") is not None):
+        return "flash_attention_2"
+    return "sdpa"
+
+def _fall_back_from_awq(reason: str):
+    """
+    The AWQ checkpoint ships its own quantization config, so no other loader can open it.
+    Switch to the unquantized base model, or fail if the AWQ model was chosen explicitly.
+    """
+    global MODEL
+    if "TRUST_MODEL" in os.environ:
+        raise RuntimeError(f"[loader] AWQ load of {MODEL} failed: {reason}. "
+                           "Install autoawq (pip install autoawq) or unset TRUST_QUANT.")
+    warnings.warn(f"[loader] AWQ load failed: {reason}. Falling back to {BASE_MODEL}.")
+    MODEL = BASE_MODEL
 
 def load_model() -> Tuple[object, object]:
     """
-    Try loading the model using bitsandbytes 4-bit quantization if CUDA is available.
+    Try loading the model using bitsandbytes 4-bit quantization if CUDA is available
+    (with TRUST_QUANT=awq, a pre-quantized AWQ checkpoint is tried first; if it cannot be
+    loaded, the unquantized BASE_MODEL is used unless TRUST_MODEL was set explicitly).
     If any error occurs, fallback to a normal (float32) load.
-    Returns (tokenizer, model).
+    Returns (tokenizer, model); with TRUST_BACKEND=vllm the model is a vLLM engine.
     """
-    global MODEL
+    global MODEL, _load_mode
+    if BACKEND == "vllm":
+        _load_mode = "vllm-awq" if QUANT == "awq" else "vllm-bnb"
+        return _load_vllm()
+
     # First load tokenizer (cheap)
     print(f"[loader] Loading tokenizer for {MODEL} ...")
-    tokenizer = AutoTokenizer.from_pretrained(MODEL, use_fast=False)
+    # left padding keeps every prompt flush against its generated tokens in a batch
+    tokenizer = AutoTokenizer.from_pretrained(MODEL, use_fast=True, padding_side="left")
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+
+    attn_impl = _attn_implementation()
+    print(f"[loader] Using attention implementation: {attn_impl}")
 
     # Try 4-bit quantized load if CUDA available
     if torch.cuda.is_available():
+        # let SDPA dispatch to its fused flash kernel whenever shapes/dtypes allow
+        torch.backends.cuda.enable_flash_sdp(True)
+        if QUANT == "awq":
+            try:
+                print("[loader] CUDA detected  attempting pre-quantized AWQ load ...")
+                # the quantization config ships with the checkpoint; AWQ kernels run in fp16
+                model = AutoModelForCausalLM.from_pretrained(
+                    MODEL,
+                    device_map="auto",
+                    torch_dtype=torch.float16,
+                    attn_implementation=attn_impl,
+                    trust_remote_code=True
+                )
+                print("[loader] Model loaded with AWQ 4-bit kernels.")
+                _load_mode = "awq-float16"
+                return tokenizer, _prepare_model(tokenizer, model)
+            except Exception as e:
+                _fall_back_from_awq(str(e))
         try:
             print("[loader] CUDA detected  attempting 4-bit bitsandbytes load ...")
+            # use bfloat16 on capable GPUs to improve stability if supported by torch
+            compute_dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
             bnb_config = BitsAndBytesConfig(
                 load_in_4bit=True,
                 bnb_4bit_use_double_quant=True,
                 bnb_4bit_quant_type="nf4",
-                # use bfloat16 on capable GPUs to improve stability if supported by torch
-                bnb_4bit_compute_dtype=torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+                bnb_4bit_compute_dtype=compute_dtype,
+                # dtype of the container holding the packed 4-bit weights (matters when sharding, e.g. FSDP)
+                bnb_4bit_quant_storage=compute_dtype
             )
             model = AutoModelForCausalLM.from_pretrained(
                 MODEL,
                 device_map="auto",
                 quantization_config=bnb_config,
+                torch_dtype=compute_dtype,  # FlashAttention-2 needs half-precision activations
+                attn_implementation=attn_impl,
                 trust_remote_code=True
             )
             print("[loader] Model loaded with bitsandbytes 4-bit quantization.")
-            return tokenizer, model
+            _load_mode = f"bnb-nf4-{str(compute_dtype).replace('torch.', '')}"
+            return tokenizer, _prepare_model(tokenizer, model)
         except Exception as e:
             warnings.warn(f"[loader] 4-bit load failed: {e}. Falling back to standard load.")
     else:
         print("[loader] No CUDA device detected  performing standard load (may be CPU-only & slow).")
+        if QUANT == "awq":
+            _fall_back_from_awq("AWQ kernels require a CUDA device")
 
     # Fallback load (may be heavy)
-    model = AutoModelForCausalLM.from_pretrained(MODEL, device_map="auto", trust_remote_code=True)
+    model = AutoModelForCausalLM.from_pretrained(MODEL, device_map="auto", attn_implementation="sdpa",
+                                                 trust_remote_code=True)
     print("[loader] Model loaded (standard precision).")
-    return tokenizer, model
+    _load_mode = f"standard-{str(model.dtype).replace('torch.', '')}"
+    return tokenizer, _prepare_model(tokenizer, model)
 
 def ensure_model():
     """Load model and tokenizer if not already loaded."""
-    global _tokenizer, _model
+    global _tokenizer, _model, _engine, _device, _decode_tokenizer
+    if BACKEND == "vllm":
+        if _engine is None:
+            _tokenizer, _engine = load_model()
+        return
     if _model is None or _tokenizer is None:
         _tokenizer, _model = load_model()
+        _decode_tokenizer = copy.deepcopy(_tokenizer)
+        _device = next(_model.parameters()).device
+
+def _to_device(inputs) -> dict:
+    """Move tokenizer output to the model device; pinned + non_blocking so H2D overlaps on CUDA."""
+    if _device.type == "cuda":
+        return {k: v.pin_memory().to(_device, non_blocking=True) for k, v in inputs.items()}
+    return {k: v.to(_device) for k, v in inputs.items()}
 
 def ask(prompt: str, max_new_tokens: int = 256) -> str:
     """
     Run the model on the prompt and return a decoded string.
-    Moves inputs to the device the model is on.
+    Moves inputs to the device the model is on (cached at load time).
+    Returns the cached output when this prompt was already generated with the same settings.
     """
-    ensure_model()
-    device = next(_model.parameters()).device
-    inputs = _tokenizer(prompt, return_tensors="pt")
-    inputs = {k: v.to(device) for k, v in inputs.items()}
+    ensure_model()  # the cache key includes how the model was loaded
+    cached = _cache_get(prompt, max_new_tokens)
+    if cached is not None:
+        return cached
+    if BACKEND == "vllm":
+        return ask_batch([prompt], max_new_tokens=max_new_tokens)[0]
+    inputs = _to_device(_tokenizer(prompt, return_tensors="pt"))
     with torch.no_grad():
-        out = _model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
+        out = _model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False, **_generate_kwargs())
     text = _tokenizer.decode(out[0], skip_special_tokens=True)
+    _cache_put(prompt, max_new_tokens, text)
     return text
 
+def encode_prompts(prompts: List[str]) -> List[List[int]]:
+    """Tokenize all prompts in one (fast, Rust-backed) tokenizer call; returns unpadded id lists."""
+    ensure_model()
+    return _tokenizer(prompts, padding=False, truncation=True)["input_ids"]
+
+def shared_prefix_len(input_ids: List[List[int]]) -> int:
+    """
+    Number of leading tokens shared by every id list, always leaving each prompt at least
+    one suffix token. Returns 0 when the shared prefix is shorter than PREFIX_MIN_TOKENS.
+    """
+    if len(input_ids) < 2:
+        return 0
+    n = min(len(os.path.commonprefix(input_ids)), min(len(ids) for ids in input_ids) - 1)
+    return n if n >= PREFIX_MIN_TOKENS else 0
+
+def _prefix_cache(prefix: List[int]):
+    """Prefill `prefix` once and keep its KV cache until a different prefix is requested."""
+    global _prefix_kv
+    if _prefix_kv is None or _prefix_kv[0] != prefix:
+        from transformers import DynamicCache
+        ids = torch.tensor([prefix], device=_device)
+        with torch.no_grad():
+            past = _model(input_ids=ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+        _prefix_kv = (prefix, past)
+    return _prefix_kv[1]
+
+def _greedy(input_ids: torch.Tensor, attention_mask: torch.Tensor, max_new_tokens: int) -> torch.Tensor:
+    """
+    Greedy decode without `generate`: one prefill, then argmax steps into a pre-allocated
+    StaticCache (fixed shapes, so a compiled forward can replay CUDA graphs).
+    Returns prompt + new ids with the same EOS/pad layout as `generate`.
+    """
+    from transformers import StaticCache
+    batch, prompt_len = input_ids.shape
+    cache = StaticCache(config=_model.config, max_batch_size=batch, max_cache_len=prompt_len + max_new_tokens,
+                        device=_device, dtype=_model.dtype)
+    eos_id, pad_id = _tokenizer.eos_token_id, _tokenizer.pad_token_id
+    # full-length mask allocated once; steps use a growing view of it
+    mask = torch.cat([attention_mask, attention_mask.new_ones(batch, max_new_tokens)], dim=1)
+    # left padding: positions count real tokens only (pads get position 0 and are masked anyway)
+    position_ids = (attention_mask.long().cumsum(-1) - 1).clamp(min=0)
+    logits = _model(
+        input_ids=input_ids,
+        attention_mask=mask[:, :prompt_len],
+        position_ids=position_ids,
+        past_key_values=cache,
+        cache_position=torch.arange(prompt_len, device=_device),
+        use_cache=True
+    ).logits[:, -1]
+    next_pos = position_ids[:, -1:] + 1
+    done = torch.zeros(batch, dtype=torch.bool, device=_device)
+    new_tokens = []
+    for step in range(max_new_tokens):
+        # rows that already emitted EOS are pad-filled, as `generate` does
+        next_tok = logits.argmax(-1, keepdim=True).masked_fill(done.unsqueeze(1), pad_id)
+        new_tokens.append(next_tok)
+        done |= next_tok.squeeze(1) == eos_id
+        if step == max_new_tokens - 1 or done.all():
+            break
+        cur = prompt_len + step
+        logits = _model(
+            input_ids=next_tok,
+            attention_mask=mask[:, :cur + 1],
+            position_ids=next_pos,
+            past_key_values=cache,
+            cache_position=torch.tensor([cur], device=_device),
+            use_cache=True
+        ).logits[:, -1]
+        next_pos = next_pos + 1
+    return torch.cat([input_ids] + new_tokens, dim=1)
+
+def _generate_batch(inputs: dict, max_new_tokens: int, **kwargs) -> Callable[[], List[str]]:
+    """
+    Greedy `generate` over a padded batch already on the model device. Returns a callable that
+    waits for the device->host copy and decodes the rows, so decoding can run off the main thread.
+    """
+    with torch.no_grad():
+        # the greedy loop owns its (static) cache, so the prefix-cache path keeps `generate`
+        if GREEDY_LOOP and "past_key_values" not in kwargs:
+            out = _greedy(inputs["input_ids"], inputs["attention_mask"], max_new_tokens)
+        else:
+            # attention_mask hides the padding; each row stops at its own EOS (later steps
+            # are pad-filled) and generation ends as soon as every row has finished
+            out = _model.generate(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                max_new_tokens=max_new_tokens,
+                do_sample=False,
+                use_cache=True,
+                eos_token_id=_tokenizer.eos_token_id,
+                pad_token_id=_tokenizer.pad_token_id,
+                **kwargs
+            )
+    if out.is_cuda:
+        # copy into pinned host memory on a side stream so the next batch's forward can
+        # be queued on the default stream without waiting for this transfer
+        copy_stream = torch.cuda.Stream()
+        copy_stream.wait_stream(torch.cuda.current_stream())
+        host = torch.empty(out.shape, dtype=out.dtype, pin_memory=True)
+        with torch.cuda.stream(copy_stream):
+            host.copy_(out, non_blocking=True)
+            copied = torch.cuda.Event()
+            copied.record(copy_stream)
+        out.record_stream(copy_stream)
+    else:
+        host, copied = out, None
+
+    def collect() -> List[str]:
+        if copied is not None:
+            copied.synchronize()
+        # pad/EOS tokens (leading padding and post-EOS fill) are special and dropped here
+        return _decode_tokenizer.batch_decode(host, skip_special_tokens=True)
+    return collect
+
+def _ask_with_prefix(input_ids: List[List[int]], prefix_len: int,
+                     max_new_tokens: int) -> Callable[[], List[str]]:
+    """
+    Batched generate reusing the cached KV of the shared prefix: only the (left-padded)
+    suffixes are prefilled. Padding sits between prefix and suffix and is masked out.
+    """
+    prefix = list(input_ids[0][:prefix_len])
+    past = copy.deepcopy(_prefix_cache(prefix))
+    past.batch_repeat_interleave(len(input_ids))
+    suffix = _tokenizer.pad({"input_ids": [ids[prefix_len:] for ids in input_ids]}, return_tensors="pt")
+    prefix_ids = torch.tensor([prefix] * len(input_ids), dtype=suffix["input_ids"].dtype)
+    inputs = _to_device({
+        "input_ids": torch.cat([prefix_ids, suffix["input_ids"]], dim=1),
+        "attention_mask": torch.cat([torch.ones_like(prefix_ids), suffix["attention_mask"]], dim=1)
+    })
+    return _generate_batch(inputs, max_new_tokens, past_key_values=past)
+
+def ask_batch(prompts: List[str], max_new_tokens: int = 256,
+              input_ids: Optional[List[List[int]]] = None, prefix_len: int = 0) -> List[str]:
+    """
+    Run the model on several prompts in a single (left-padded) generate call.
+    Pass `input_ids` from `encode_prompts` to skip re-tokenizing `prompts`, and
+    `prefix_len` from `shared_prefix_len` to reuse the KV cache of the shared prefix.
+    Prompts with a cached output are not regenerated.
+    Returns one decoded string per prompt, in the same order as `prompts`.
+    """
+    return ask_batch_async(prompts, max_new_tokens, input_ids, prefix_len).result()
+
+def ask_batch_async(prompts: List[str], max_new_tokens: int = 256,
+                    input_ids: Optional[List[List[int]]] = None, prefix_len: int = 0) -> "Future[List[str]]":
+    """
+    Like `ask_batch`, but returns as soon as generation is done: the host copy, decoding and
+    cache writes finish on a background thread. Generation errors are raised here, not via the Future.
+    """
+    ensure_model()  # the cache key includes how the model was loaded
+    outs = [_cache_get(p, max_new_tokens) for p in prompts]
+    misses = [i for i, o in enumerate(outs) if o is None]
+    collect = None
+    if misses:
+        collect = _ask_batch_uncached(
+            [prompts[i] for i in misses],
+            max_new_tokens,
+            [input_ids[i] for i in misses] if input_ids is not None else None,
+            prefix_len
+        )
+
+    def finish() -> List[str]:
+        if collect is not None:
+            for i, text in zip(misses, collect()):
+                outs[i] = text
+                _cache_put(prompts[i], max_new_tokens, text)
+        return outs
+    return _decode_pool.submit(finish)
+
+def _ask_batch_uncached(prompts: List[str], max_new_tokens: int,
+                        input_ids: Optional[List[List[int]]], prefix_len: int) -> Callable[[], List[str]]:
+    """Generate every prompt (no cache lookup); returns a collect() callable, see `_generate_batch`."""
+    ensure_model()
+    if BACKEND == "vllm":
+        texts = _ask_vllm(prompts, max_new_tokens)
+        return lambda: texts
+    # the prefix cache is a DynamicCache, so it is skipped when decoding into a static cache
+    if input_ids is not None and prefix_len and not COMPILE:
+        return _ask_with_prefix(input_ids, prefix_len, max_new_tokens)
+    if input_ids is not None:
+        # pad the pre-tokenized ids (left side) and build the matching attention mask
+        inputs = _tokenizer.pad({"input_ids": input_ids}, return_tensors="pt")
+    else:
+        inputs = _tokenizer(prompts, return_tensors="pt", padding=True, truncation=True)
+    return _generate_batch(_to_device(inputs), max_new_tokens, **_generate_kwargs())
+
+def _ask_vllm(prompts: List[str], max_new_tokens: int) -> List[str]:
+    """Greedy-decode all prompts in one vLLM call; the engine schedules the batching."""
+    from vllm import SamplingParams
+    params = SamplingParams(max_tokens=max_new_tokens, temperature=0)
+    results = _engine.generate(prompts, params)
+    # vLLM returns only the completion; prepend the prompt so outputs match the HF path,
+    # which decodes the full sequence (prompt included)
+    return [r.prompt + r.outputs[0].text for r in results]
+
 if __name__ == "__main__":
     # quick local smoke test
     ensure_model()